@@ -1,9 +1,17 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import re
 import pickle
 import pprint
 from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# orjson decodes responses noticeably faster when it is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 MALLARD_ENDPOINT = "http://localhost:2626/parse"
@@ -11,171 +19,219 @@ LANGUAGE = 'eng'
 
 DUCKLING_ENDPOINT = "http://0.0.0.0:8000/parse"
 
+# Number of requests kept in flight at once when querying Mallard/Duckling
+MAX_WORKERS = 32
+
+# Shared session so connections to both recognizers are kept alive and reused
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS))
 
-def remove_role_and_sys(x):
-    if '|' in x:
-        index = x.index('|')
-        return x[4:index]
-    else:
-        return x[4:]
+# Labeled entities look like {text|label} or {text|label|role}. Captures the entity text and,
+# for system entities, the bare label without the sys_ prefix or the role
+ENTITY_RE = re.compile(r'{([^{}|]+)\|(?:sys_([^\s{}|]+)|[^\s{}|]+)(?:\|[^\s{}|]+)?}')
 
 
-def get_expected_spans(clean, labeled):
+def get_expected_spans(labeled):
     """
-    Extract system entities from each query, with start, end, and label for each entity
+    Extract system entities from each query, with start, end, and label for each entity.
+    Indices are into the clean query, i.e. the labeled query with all entity markup removed
 
-    :param clean: queries with no entity labels
     :param labeled: queries with entity labels
     :return: entity spans for each query, each entity span in form (start_index, end_index, label)
     """
     all_spans = []
-    for clean_query, labeled_query in zip(clean, labeled):
+    for labeled_query in labeled:
         # Actual entity spans in the clean query
         spans = []
-        entities = re.findall('{([^{]+)\|sys_[^\s]*}', labeled_query)
-        entity_labels = re.findall('{[^{]+\|(sys_[^\s]*)}', labeled_query)
-        entity_labels = [remove_role_and_sys(x) for x in entity_labels]
-
-        # Advance through the query so we don't get repeat spans
-        start_position = 0
-        for e, label in zip(entities, entity_labels):
-            start_index = clean_query.index(e, start_position)
+
+        # Number of markup characters seen so far, which don't appear in the clean query
+        markup_length = 0
+        for m in ENTITY_RE.finditer(labeled_query):
+            e, label = m.group(1, 2)
+            start_index = m.start() - markup_length
             end_index = start_index + len(e)
-            spans.append((start_index, end_index, label))
 
-            start_position = end_index
+            # Only system entities are expected, but every entity's markup shifts the offsets
+            if label is not None:
+                spans.append((start_index, end_index, label))
+
+            markup_length += m.end() - m.start() - len(e)
 
         all_spans.append(spans)
 
     return all_spans
 
 
-def get_mallard_results(queries):
+def _post_queries(endpoint, payloads, parse):
     """
-    Return results of each Mallard call on our queries
-    :param queries: Clean queries with no labels
-    :return:
+    POST every payload to the endpoint concurrently, keeping the input order
+    :param endpoint: URL of the entity recognizer
+    :param payloads: list of (kwargs for requests, data) pairs, one per query
+    :param parse: function mapping a decoded JSON response to the result we keep
+    :return: results for each query that succeeded, in query order
     """
-    responses = []
-
-    for i, query in enumerate(queries):
+    def fetch(indexed_payload):
+        i, (kwargs, data) = indexed_payload
 
         if i % 1000 == 0:
             print(i)
 
-        data = {
-            'text': query,
-            'language': LANGUAGE
-        }
-
         try:
-            response = requests.request('POST', MALLARD_ENDPOINT, json=data)
-            response = response.json()
-            responses.append(response['data'])
+            response = SESSION.post(endpoint, **kwargs)
+            response = json_loads(response.content)
+            return parse(response)
         except Exception as ex:
             print('Numerical Entity Recognizer Error %s\nURL: %r\nData: %s',
-                  ex, MALLARD_ENDPOINT, json.dumps(data))
+                  ex, endpoint, json.dumps(data))
+            return None
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = executor.map(fetch, enumerate(payloads))
+        responses = [r for r in results if r is not None]
 
     return responses
 
 
-def get_duckling_results(queries):
+def get_mallard_results(queries):
     """
-    Return results of each Duckling call on our queries
+    Return results of each Mallard call on our queries
     :param queries: Clean queries with no labels
     :return:
     """
-    responses = []
+    payloads = []
+    for query in queries:
+        data = {
+            'text': query,
+            'language': LANGUAGE
+        }
+        payloads.append(({'json': data}, data))
 
-    for i, query in enumerate(queries):
+    return _post_queries(MALLARD_ENDPOINT, payloads, lambda response: response['data'])
 
-        if i % 1000 == 0:
-            print(i)
 
+def get_duckling_results(queries):
+    """
+    Return results of each Duckling call on our queries
+    :param queries: Clean queries with no labels
+    :return:
+    """
+    payloads = []
+    for query in queries:
         data = {
             'text': query,
         }
+        payloads.append(({'data': data}, data))
 
-        try:
-            response = requests.request('POST', DUCKLING_ENDPOINT, data=data)
-            response = response.json()
-            responses.append(response)
-        except Exception as ex:
-            print('Numerical Entity Recognizer Error %s\nURL: %r\nData: %s',
-                  ex, MALLARD_ENDPOINT, json.dumps(data))
+    return _post_queries(DUCKLING_ENDPOINT, payloads, lambda response: response)
 
-    return responses
+
+def save_results(results, path):
+    """
+    Cache raw Mallard/Duckling results so later analysis runs don't need to query the servers
+    :param results: results from get_mallard_results or get_duckling_results
+    :param path: pickle file to write
+    :return:
+    """
+    with open(path, "wb") as f:
+        pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_results(path):
+    """
+    Load raw Mallard/Duckling results cached by save_results
+    :param path: pickle file to read
+    :return: cached results
+    """
+    with open(path, "rb") as f:
+        return pickle.load(f)
 
 
 def parse_mallard_response(response):
     """
     Gets all predicted entities from a single Mallard response
     :param response: Mallard response
-    :return: dict with keys being dimensions and values being another dict that maps span to value
+    :return: dict mapping (dimension, start_index, end_index) to value
     """
-    possible_entities = defaultdict(dict)
-
-    try:
-        for r in response:
-            dimension = r['dimension']
-            span = (r['entity']['start'], r['entity']['end'])
+    possible_entities = {}
 
+    for r in response:
+        # Skip malformed entities without discarding the rest of the response
+        try:
+            key = (r['dimension'], r['entity']['start'], r['entity']['end'])
             value = r['value'][0]
+        except (KeyError, IndexError, TypeError) as exp:
+            print(exp)
+            print(r)
+            continue
 
-            possible_entities[dimension][span] = value
-    except Exception as exp:
-        print(dimension)
-        print(exp)
-        print(r)
+        possible_entities[key] = value
 
     return possible_entities
 
 
+def get_value_or_interval(value):
+    """
+    Gets a single value, or a (from, to) tuple for intervals, from a Duckling value
+    :param value: 'value' field of a Duckling entity
+    :return: value or (from, to) tuple
+    """
+    if value['type'] == 'value':
+        return value['value']
+    return (value.get('from', None), value.get('to', None))
+
+
+def get_time_value(value):
+    """
+    Gets a single time, or a (from, to) tuple for time intervals, from a Duckling time value
+    :param value: 'value' field of a Duckling time entity
+    :return: time, (from, to) tuple, or None for unknown time types
+    """
+    if value['type'] not in ('value', 'interval'):
+        print("UNEXPECTED TIME VALUE")
+        return None
+    return get_value_or_interval(value)
+
+
+# Dimensions whose Duckling values may be intervals. Every other dimension has a plain value
+DUCKLING_VALUE_PARSERS = {
+    'time': get_time_value,
+    'temperature': get_value_or_interval,
+    'amount-of-money': get_value_or_interval,
+}
+
+
 def parse_duckling_response(response):
     """
     Gets all predicted entities from a single Duckling response
     :param response: Duckling response
-    :return: dict with keys being dimensions and values being another dict that maps span to value
+    :return: dict mapping (dimension, start_index, end_index) to value
     """
-    possible_entities = defaultdict(dict)
+    possible_entities = {}
 
     for r in response:
         dimension = r['dim']
-        span = (r['start'], r['end'])
-        value = None
-
-        if dimension == 'time':
-            type_ = r['value']['type']
-            # Single time
-            if type_ == 'value':
-                value = r['value']['value']
-            # Time intervals
-            elif type_ == 'interval':
-                value = (r['value'].get('from', None), r['value'].get('to', None))
-            else:
-                print("UNEXPECTED TIME VALUE")
+        key = (dimension, r['start'], r['end'])
 
-        elif dimension == 'temperature':
-            type_ = r['value']['type']
-            if type_ == 'value':
-                value = r['value']['value']
-            else:
-                value = (r['value'].get('from', None), r['value'].get('to', None))
-
-        elif dimension == 'amount-of-money':
-            type_ = r['value']['type']
-            if type_ == 'value':
-                value = r['value']['value']
-            else:
-                value = (r['value'].get('from', None), r['value'].get('to', None))
-        else:
+        parse_value = DUCKLING_VALUE_PARSERS.get(dimension)
+        if parse_value is None:
             value = r['value']['value']
+        else:
+            value = parse_value(r['value'])
 
-        possible_entities[dimension][span] = value
+        possible_entities[key] = value
 
     return possible_entities
 
 
+def get_dimensions(output):
+    """
+    Gets the dimensions predicted in a single parsed response
+    :param output: PARSED mallard/duckling response
+    :return: list of dimensions, in the order they were first predicted
+    """
+    return list(dict.fromkeys(dimension for dimension, _, _ in output))
+
+
 def evaluate_ser(entity, outputs):
     """
     Get all correct and incorrect queries. Correct means all entities are identified correctly
@@ -192,15 +248,10 @@ def evaluate_ser(entity, outputs):
         correct = True
 
         # For each entity, see if it is present in the mallard output
-        for entity in entity_info:
-            span = (entity[0], entity[1])
-            entity_type = entity[2]
-
-            if entity_type not in output:
+        for start_index, end_index, entity_type in entity_info:
+            if (entity_type, start_index, end_index) not in output:
                 correct = False
-            else:
-                if span not in output[entity_type]:
-                    correct = False
+                break
         if correct:
             correct_queries.append(i)
         else:
@@ -225,21 +276,24 @@ def evaluate_ser_errors(entities, outputs):
         missed_entity = False
         incorrect_span = False
 
-        for entity in entity_info:
-            span = (entity[0], entity[1])
-            entity_type = entity[2]
+        for start_index, end_index, entity_type in entity_info:
+            if (entity_type, start_index, end_index) in output:
+                continue
 
-            if entity_type not in output:
+            if not any(dimension == entity_type for dimension, _, _ in output):
                 # Completely not predicted
-                if i not in missed_entity_indices:
-                    missed_entity_indices.append(i)
                 missed_entity = True
             else:
-                if span not in output[entity_type]:
-                    if i not in incorrect_span_indices:
-                        incorrect_span_indices.append(i)
-                    incorrect_span = True
+                incorrect_span = True
 
+            if missed_entity and incorrect_span:
+                break
+
+        # Each query is only visited once, so the index lists stay sorted and free of duplicates
+        if missed_entity:
+            missed_entity_indices.append(i)
+        if incorrect_span:
+            incorrect_span_indices.append(i)
         if not missed_entity and not incorrect_span:
             correct_indices.append(i)
 
@@ -260,18 +314,12 @@ def compare_mallard_duckling(mallards, ducklings):
     for i, (mallard, duckling) in enumerate(zip(mallards, ducklings)):
         same = True
 
-        for type_, infos in duckling.items():
-            if type_ == 'amount-of-money':
+        for key in duckling:
+            if key[0] == 'amount-of-money':
                 continue
-            if type_ not in mallard:
+            if key not in mallard:
                 same = False
-            else:
-                duckling_spans = list(infos.keys())
-                mallard_spans = list(mallard[type_].keys())
-
-                for d in duckling_spans:
-                    if d not in mallard_spans:
-                        same = False
+                break
         if same:
             present.append(i)
         else:
@@ -283,21 +331,20 @@ def compare_mallard_duckling(mallards, ducklings):
 def find_duckling_conflict_queries(duckling_outputs):
     """
     Finds queries where duckling predicts multiple entities for the SAME span
-    :param duckling_outputs: PARSED duckling responses, dicts from dimension to a dict mapping tuple spans to values
+    :param duckling_outputs: PARSED duckling responses, dicts from (dimension, start, end) to values
     :return:
     """
     conflict_responses = {}
 
     for i, response in enumerate(duckling_outputs):
-        response_values = list(response.values())
-        response_spans = []
-
-        for rv in response_values:
-            spans = list(rv.keys())
-            response_spans.extend(spans)
+        seen_spans = set()
 
-        if len(response_spans) != len(set(response_spans)):
-            conflict_responses[i] = response
+        for _, start, end in response:
+            span = (start, end)
+            if span in seen_spans:
+                conflict_responses[i] = response
+                break
+            seen_spans.add(span)
 
     return conflict_responses
 
@@ -307,34 +354,26 @@ if __name__ == "__main__":
     pp = pprint.PrettyPrinter(indent=2)
 
     with open("sys_queries.txt", "r") as f:
-        queries_labeled = f.readlines()
-        queries_labeled = [x.strip() for x in queries_labeled]
+        queries_labeled = f.read().splitlines()
 
     with open("sys_queries_clean.txt", "r") as f:
-        queries_clean = f.readlines()
-        queries_clean = [x.strip() for x in queries_clean]
+        queries_clean = f.read().splitlines()
 
-    entity_spans = get_expected_spans(queries_clean, queries_labeled)
+    entity_spans = get_expected_spans(queries_labeled)
 
     # Test that the Mallard return matches each retrieved span
     # duckling_results = get_duckling_results(queries_clean)
     # mallard_results = get_mallard_results(queries_clean)
+    # save_results(duckling_results, "duckling_results.p")
+    # save_results(mallard_results, "mallard_results.p")
 
     # Load from pickle to save time
-    duckling_results = pickle.load(open("duckling_results.p", "rb"))
-    mallard_results = pickle.load(open("mallard_results.p", "rb"))
+    duckling_results = load_results("duckling_results.p")
+    mallard_results = load_results("mallard_results.p")
 
     # Parse the entity spans/values from duckling and mallard
-    duckling_outputs = []
-    mallard_outputs = []
-
-    for i, dr in enumerate(duckling_results):
-        duckling_entities = parse_duckling_response(dr)
-        duckling_outputs.append(duckling_entities)
-
-    for mr in mallard_results:
-        mallard_entities = parse_mallard_response(mr)
-        mallard_outputs.append(mallard_entities)
+    duckling_outputs = [parse_duckling_response(dr) for dr in duckling_results]
+    mallard_outputs = [parse_mallard_response(mr) for mr in mallard_results]
 
     # Compare to ground truth labels
     correct_mallard, incorrect_mallard = evaluate_ser(entity_spans, mallard_outputs)  # (6562, 5803)
@@ -343,7 +382,7 @@ if __name__ == "__main__":
     present, not_present = compare_mallard_duckling(mallard_outputs, duckling_outputs)  # (8764, 3601)
 
     # Queries that duckling gets wrong but mallard doesn't get wrong
-    duckling_regressions = list(set(incorrect_duckling) - set(incorrect_duckling).intersection(set(incorrect_mallard)))
+    duckling_regressions = sorted(set(incorrect_duckling).difference(incorrect_mallard))
 
     # Get queries where Duckling predicts different entities for the same span, 996 total
     conflict_responses = find_duckling_conflict_queries(duckling_outputs)
@@ -362,20 +401,21 @@ if __name__ == "__main__":
         duckling_regression_entity_spans, duckling_regression_outputs)
     # 564, 71, 0 for duckling regressions
 
-    difference_counts = defaultdict(list)
+    # Counts of (expected dimension, actual dimension) mismatches
+    difference_pair_counts = Counter()
 
     with open('duckling_missed_entities.txt', 'w') as f:
         for i in missed_entity_indices:
             # if len(list(duckling_regression_outputs[i].keys())) > 1:
             #     print(i)
             expected_sys_entities = [x[2] for x in duckling_regression_entity_spans[i]]
-            actual_sys_entities = list(duckling_regression_outputs[i].keys())
+            actual_sys_entities = get_dimensions(duckling_regression_outputs[i])
 
-            f.write(f"Index: {i}\n")
-            f.write("Query: " + duckling_regressions_queries_labeled[i] + '\n')
-            f.write("Expected Sys Entities: " + ", ".join(expected_sys_entities) + '\n')
-            f.write("Actual Sys Entities: " + ", ".join(actual_sys_entities) + '\n')
-            f.write("\n")
+            f.write(f"Index: {i}\n"
+                    f"Query: {duckling_regressions_queries_labeled[i]}\n"
+                    f"Expected Sys Entities: {', '.join(expected_sys_entities)}\n"
+                    f"Actual Sys Entities: {', '.join(actual_sys_entities)}\n"
+                    f"\n")
 
             for k, expected_pred in enumerate(expected_sys_entities):
 
@@ -385,10 +425,11 @@ if __name__ == "__main__":
                     actual_pred = actual_sys_entities[k]
 
                 if expected_pred != actual_pred:
-                    difference_counts[expected_pred].append(actual_pred)
+                    difference_pair_counts[(expected_pred, actual_pred)] += 1
 
-    for dim, mistakes in difference_counts.items():
-        difference_counts[dim] = Counter(mistakes)
+    difference_counts = defaultdict(Counter)
+    for (expected_pred, actual_pred), count in difference_pair_counts.items():
+        difference_counts[expected_pred][actual_pred] = count
 
     difference_counts = dict(difference_counts)
 